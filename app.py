@@ -1,18 +1,30 @@
 import streamlit as st
-from kiteconnect import KiteConnect
 from supabase import create_client
 import logging
-import json
+import orjson
 import os
-import pandas as pd
-from datetime import datetime, date
-import math
-from kite_utils import place_buy_order, place_sell_order, get_ohlc_data
+import threading
+from datetime import datetime, date, timedelta, timezone
+from kite_utils import (
+    place_legs,
+    get_quotes,
+    prefetch_quotes,
+    get_ltps,
+    OrderRow,
+    ACTION_LEGS,
+    TickStream,
+)
 
 # --- Configuration ---
 st.set_page_config(page_title="Scanner Approval", page_icon="✅")
 logging.basicConfig(level=logging.INFO)
 CACHE_FILE = "kite_session.json"
+TOKEN_REVALIDATE_AFTER = timedelta(hours=4)
+IST = timezone(timedelta(hours=5, minutes=30))
+# Max order requests in flight; the per-second rate is capped in kite_utils
+ORDER_WORKERS = 8
+SCANNER_RESULT_LIMIT = 500  # Upper bound on rows pulled per scanner date
+COMPACT_SELECTION_MAX = 20  # Up to this many results use the lightweight picker
 
 # --- Session Initialization ---
 if "user_api_key" not in st.session_state:
@@ -21,18 +33,24 @@ if "is_logged_in" not in st.session_state:
     st.session_state.is_logged_in = False
 
 # Scanner state
-if "scanner_data" not in st.session_state:
-    st.session_state.scanner_data = []  # Raw data from DB
+if "scanner_df" not in st.session_state:
+    st.session_state.scanner_df = None  # Data from DB, as the editor frame
 if "selected_scanner_data" not in st.session_state:
     st.session_state.selected_scanner_data = (
         []
     )  # Data filtered and finalized for review
+if "finalized_multiplier" not in st.session_state:
+    st.session_state.finalized_multiplier = None  # Multiplier the targets use
 if "selection_done" not in st.session_state:
     st.session_state.selection_done = False  # UX Toggle
 if "capital" not in st.session_state:
     st.session_state.capital = 100000
 if "capital_strategy" not in st.session_state:
     st.session_state.capital_strategy = "One each"
+if "quote_cache" not in st.session_state:
+    st.session_state.quote_cache = {}  # Batched Kite quotes keyed by instrument
+if "quote_lock" not in st.session_state:
+    st.session_state.quote_lock = threading.Lock()  # Guards background prefetch
 
 
 # --- Supabase Initialization ---
@@ -46,6 +64,7 @@ def init_supabase():
 
         url = st.secrets["supabase"]["url"]
         key = st.secrets["supabase"]["key"]
+
         return create_client(url, key)
     except Exception as e:
         st.error(f"Supabase initialization failed: {e}")
@@ -55,44 +74,135 @@ def init_supabase():
 supabase = init_supabase()
 
 
+# --- Kite Initialization ---
+@st.cache_resource
+def get_kite(api_key, access_token):
+    """Returns a shared KiteConnect client so its HTTP session survives reruns."""
+    from kiteconnect import KiteConnect
+    from urllib3.util.retry import Retry
+
+    # Retry idempotent reads on transient gateway errors; order writes
+    # (POST/PUT/DELETE) are never resent, and an exhausted retry surfaces
+    # Kite's own error response instead of a RetryError
+    pool = {
+        "max_retries": Retry(
+            total=2,
+            backoff_factor=0.1,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        ),
+    }
+    kite = KiteConnect(api_key=api_key, pool=pool)
+    kite.set_access_token(access_token)
+    return kite
+
+
+@st.cache_resource
+def get_tick_stream(api_key, access_token):
+    """Returns a shared KiteTicker stream, or None if the websocket can't be opened."""
+    try:
+        return TickStream(api_key, access_token)
+    except Exception as e:
+        logging.warning(f"Tick stream unavailable, using REST quotes: {e}")
+        return None
+
+
+def current_tick_stream():
+    """The tick stream for the logged-in account."""
+    stream = get_tick_stream(
+        st.session_state.user_api_key, st.session_state.access_token
+    )
+    # Remembered so logout can close it without opening a new one
+    st.session_state._tick_stream = stream
+    return stream
+
+
+def close_tick_stream():
+    """Closes this account's tick stream and drops it from the resource cache."""
+    stream = st.session_state.get("_tick_stream")
+    if stream is None:
+        return
+    stream.close()
+    get_tick_stream.clear(
+        st.session_state.user_api_key, st.session_state.access_token
+    )
+
+
 # --- Persistence Functions ---
+def _write_session_file(data):
+    """Atomically replaces the cache file."""
+    tmp = CACHE_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(data, default=str))
+    os.replace(tmp, CACHE_FILE)
+
+
 def save_session_to_disk(api_key, access_token, user_data):
     """Saves Kite session details to a local cache file."""
     try:
-        with open(CACHE_FILE, "w") as f:
-            json.dump(
-                {
-                    "api_key": api_key,
-                    "access_token": access_token,
-                    "user_data": user_data,
-                    "timestamp": str(datetime.now()),
-                },
-                f,
-            )
+        _write_session_file(
+            {
+                "api_key": api_key,
+                "access_token": access_token,
+                "user_data": user_data,
+                "timestamp": datetime.now(),
+                "validated_at": datetime.now(),
+            }
+        )
     except Exception as e:
         st.warning(f"Could not save session cache: {e}")
 
 
+def update_session_on_disk(**fields):
+    """Updates only the given fields of the cached session (e.g. on token refresh)."""
+    try:
+        with open(CACHE_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+        data.update(fields)
+        _write_session_file(data)
+    except Exception as e:
+        st.warning(f"Could not update session cache: {e}")
+
+
+def _last_token_rollover():
+    """Returns the most recent 06:00 IST (when Kite tokens expire) as local time."""
+    now = datetime.now(IST)
+    rollover = now.replace(hour=6, minute=0, second=0, microsecond=0)
+    if now < rollover:
+        rollover -= timedelta(days=1)
+    return rollover.astimezone().replace(tzinfo=None)
+
+
 def load_session_from_disk():
     """Loads Kite session details from a local cache file."""
-    if not os.path.exists(CACHE_FILE):
-        return False
     try:
-        with open(CACHE_FILE, "r") as f:
-            data = json.load(f)
+        with open(CACHE_FILE, "rb") as f:
+            data = orjson.loads(f.read())
         if not data.get("access_token") or not data.get("api_key"):
             return False
 
-        # Validate token by making a call
-        kite = KiteConnect(api_key=data["api_key"])
-        kite.set_access_token(data["access_token"])
-        kite.profile()
+        # Validate token by making a call, unless it was validated recently
+        # and Kite's daily token rollover hasn't happened since
+        validated_at = data.get("validated_at")
+        if validated_at:
+            validated_at = datetime.fromisoformat(validated_at)
+        if (
+            not validated_at
+            or validated_at < _last_token_rollover()
+            or datetime.now() - validated_at > TOKEN_REVALIDATE_AFTER
+        ):
+            kite = get_kite(data["api_key"], data["access_token"])
+            kite.profile()
+            update_session_on_disk(validated_at=datetime.now())
 
         st.session_state.user_api_key = data["api_key"]
         st.session_state.access_token = data["access_token"]
         st.session_state.user_data = data.get("user_data", {})
         st.session_state.is_logged_in = True
         return True
+    except FileNotFoundError:
+        return False
     except Exception:
         # If validation fails, clear the cache
         clear_local_cache()
@@ -101,12 +211,16 @@ def load_session_from_disk():
 
 def clear_local_cache():
     """Removes the local session cache file."""
-    if os.path.exists(CACHE_FILE):
+    try:
         os.remove(CACHE_FILE)
+    except FileNotFoundError:
+        pass
 
 
 def finalize_login(request_token, api_key, api_secret):
     """Generates the access token using the request token."""
+    from kiteconnect import KiteConnect
+
     try:
         kite = KiteConnect(api_key=api_key)
         data = kite.generate_session(request_token, api_secret=api_secret)
@@ -122,210 +236,394 @@ def finalize_login(request_token, api_key, api_secret):
 
 
 def logout():
-    """Clears session state and local cache to log out."""
+    """
+    Clears session state and local cache to log out. Used as the Logout
+    button's `on_click`, so the click's own rerun renders the login page.
+    """
+    close_tick_stream()
     st.session_state.clear()
     clear_local_cache()
+
+
+def handle_token_expiry():
+    """Purges a session whose token Kite has rejected and returns to login."""
+    logging.warning("Kite rejected the access token; clearing cached session.")
+    logout()
     st.rerun()
 
 
 # --- Scanner Logic ---
 
 
+@st.cache_data(ttl=5, show_spinner=False)
+def _fetch_quote(_kite_client, symbols):
+    """Batched quote fetch, memoized briefly so reruns don't re-hit Kite."""
+    return get_quotes(_kite_client, list(symbols))
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_scanner_results_cached(selected_date, table="scanner_results"):
+    """Queries Supabase for a date; memoized so repeat fetches skip the round trip."""
+    response = (
+        init_supabase()
+        .table(table)
+        .select("symbol, rationale, true_range")
+        .eq("date", selected_date.isoformat())
+        .order("symbol")
+        .limit(SCANNER_RESULT_LIMIT)
+        .execute()
+    )
+    return response.data
+
+
 def fetch_scanner_results(selected_date):
     """Fetches data from Supabase based on date."""
     if not supabase:
         return []
 
     try:
-        date_str = selected_date.strftime("%Y-%m-%d")
-        response = (
-            supabase.table("scanner_results")
-            .select("rationale, symbol, true_range")
-            .eq("date", date_str)
-            .execute()
-        )
-        return response.data
+        return _fetch_scanner_results_cached(selected_date)
     except Exception as e:
         st.error(f"Supabase Query Error: {e}")
         return []
 
 
+def _merge_ticks(stream, cache, symbols):
+    """
+    Overlays streamed ticks onto the cached quotes for `symbols` and keeps
+    every quoted symbol subscribed. Returns the symbols refreshed from ticks.
+    """
+    tokens = {
+        quote["instrument_token"]: s
+        for s in symbols
+        if "instrument_token" in (quote := cache.get(f"NSE:{s}", {}))
+    }
+    stream.subscribe(tokens)
+    ticks = stream.get(tokens)
+    for token, tick in ticks.items():
+        instrument = f"NSE:{tokens[token]}"
+        cache[instrument] = {**cache[instrument], **tick}
+    return {tokens[token] for token in ticks}
+
+
+def refresh_quote_cache(kite_client, symbols, force=False):
+    """
+    Fills the quote cache for `symbols`, fetching only what the tick stream and
+    the background prefetch have not already delivered (or delivered without
+    an open price). With `force`, all symbols are re-quoted in one batched
+    call, bypassing the stream. Returns False if the batched call failed.
+    """
+    cache = st.session_state.quote_cache
+    stream = current_tick_stream()
+    with st.session_state.quote_lock:
+        if force:
+            missing = set(symbols)
+        else:
+            streamed = _merge_ticks(stream, cache, symbols) if stream else set()
+            missing = {
+                s
+                for s in symbols
+                if s not in streamed
+                and not cache.get(f"NSE:{s}", {}).get("ohlc", {}).get("open")
+            }
+    if not missing:
+        return True
+
+    from kiteconnect.exceptions import TokenException
+
+    try:
+        if force:
+            # Skip the memoized response so a forced refresh is really fresh
+            quotes = get_quotes(kite_client, sorted(missing))
+        else:
+            quotes = _fetch_quote(kite_client, tuple(sorted(missing)))
+    except TokenException:
+        handle_token_expiry()
+    except Exception as e:
+        logging.warning(f"Batch quote fetch failed: {e}")
+        return False
+    with st.session_state.quote_lock:
+        cache.update(quotes)
+    if stream:
+        # Stream these from now on instead of re-quoting them
+        stream.subscribe(
+            q["instrument_token"] for q in quotes.values() if "instrument_token" in q
+        )
+    return True
+
+
 def reset_selection():
     """R esets the workflow to the selection phase."""
     st.session_state.selection_done = False
     st.session_state.selected_scanner_data = []
 
 
-def calculate_quantity_and_finalize(
-    kite_client, selected_data, multiplier, capital, strategy
-):
+def _compute_targets(open_price, true_range, multiplier):
+    """Returns the (BUY, SELL) limit prices around the open, rounded to 0.1."""
+    delta = float(true_range) * multiplier
+
+    # Apply rounding to 1 decimal place (multiple of 0.1) as requested
+    return round(open_price - delta, 1), round(open_price + delta, 1)
+
+
+def reprice_orders(rows, multiplier):
+    """Recomputes BUY/SELL targets from the stored open prices, without re-quoting."""
+    repriced = []
+    for row in rows:
+        buy_price, sell_price = _compute_targets(
+            row.open_price, row.true_range, multiplier
+        )
+        repriced.append(row._replace(buy_price=buy_price, sell_price=sell_price))
+    return repriced
+
+
+def calculate_quantity_and_finalize(selected_data, multiplier, capital, strategy):
     """
     Calculates final prices, quantities, and prepares the data for review.
+    Returns a list of `OrderRow` tuples.
 
     UPDATED: Buy/Sell prices rounded to 1 decimal place (multiple of 0.1).
     UPDATED: Equal distribution quantity based on Open Price.
     """
-    finalized_data = []
+    import numpy as np
 
-    # 1. Fetch OHLC data for all selected stocks
-    symbols = [row["symbol"] for row in selected_data]
-    ohlc_map = {}
-    for symbol in symbols:
-        _, open_price = get_ohlc_data(kite_client, symbol)
-        ohlc_map[symbol] = open_price
+    # 1. Read open prices for the selected stocks from the batched quote cache
+    # Each symbol once, however many rows select it
+    symbols = list({row["symbol"] for row in selected_data})
+    with st.session_state.quote_lock:
+        quote_cache = dict(st.session_state.quote_cache)
 
-    # 2. Calculate final order details (Buy Price, Sell Price, Delta)
-    for row in selected_data:
-        symbol = row["symbol"]
-        open_price = ohlc_map.get(symbol, 0.0)
+    ohlc_map = {
+        symbol: quote_cache.get(f"NSE:{symbol}", {}).get("ohlc", {}).get("open", 0.0)
+        for symbol in symbols
+    }
 
-        if open_price == 0.0:
+    # 2. Drop rows without an open price; the rest are priced together
+    finalized_data = []
+    for row in selected_data:
+        if ohlc_map.get(row["symbol"], 0.0) == 0.0:
             st.warning(
-                f"Skipping {symbol}: Could not fetch Open Price. Ensure the market is open or data is available."
+                f"Skipping {row['symbol']}: Could not fetch Open Price. Ensure the market is open or data is available."
             )
             continue
-
-        metric_base_val = float(row.get("true_range", 0))
-        delta = metric_base_val * multiplier
-
-        # Calculate raw Buy and Sell prices
-        calc_buy = open_price - delta
-        calc_sell = open_price + delta
-
-        # Apply rounding to 1 decimal place (multiple of 0.1) as requested
-        row["open_price"] = float(f"{open_price:.2f}")
-        row["buy_price"] = round(calc_buy, 1)  # Rounded to 0.1 precision
-        row["sell_price"] = round(calc_sell, 1)  # Rounded to 0.1 precision
         finalized_data.append(row)
 
     if not finalized_data:
         st.error("No stocks could be processed after fetching market data.")
         return []
 
-    # 3. Calculate Quantity based on Strategy
-    num_stocks = len(finalized_data)
-
-    for row in finalized_data:
-        if strategy == "One each":
-            row["quantity"] = 1
-
-        elif strategy == "Equal distribution":
-            if num_stocks > 0:
-                # Calculate budget per stock
-                budget_per_stock = capital / num_stocks
-
-                # Use Open Price as the basis for quantity calculation (Requested change)
-                price_proxy = row["open_price"]
-
-                if price_proxy > 0:
-                    quantity = math.floor(budget_per_stock / price_proxy)
-                    # Ensure minimum quantity of 1 if budget allows
-                    row["quantity"] = max(1, quantity)
-                else:
-                    row["quantity"] = 1  # Fallback
-
-    return finalized_data
+    # 3. Calculate final order details (Buy Price, Sell Price, Delta); the
+    # targets share `_compute_targets` with repricing so both round alike
+    raw_opens = [ohlc_map[r["symbol"]] for r in finalized_data]
+    targets = [
+        _compute_targets(open_price, r.get("true_range", 0), multiplier)
+        for open_price, r in zip(raw_opens, finalized_data)
+    ]
+    opens = np.array([round(o, 2) for o in raw_opens], dtype=np.float64)
+
+    # 4. Calculate Quantity based on Strategy
+    if strategy == "Equal distribution":
+        # Equal budget per stock, sized off the Open Price (Requested change);
+        # at least 1 share each
+        qtys = np.maximum(1, np.floor(capital / len(opens) / opens)).astype(int)
+    else:
+        qtys = np.ones(len(opens), dtype=int)
+
+    return [
+        OrderRow(
+            symbol=row["symbol"],
+            rationale=row.get("rationale"),
+            true_range=row.get("true_range", 0),
+            action=row["Action"],
+            open_price=open_price,
+            buy_price=buy_price,
+            sell_price=sell_price,
+            quantity=quantity,
+        )
+        for row, open_price, (buy_price, sell_price), quantity in zip(
+            finalized_data, opens.tolist(), targets, qtys.tolist()
+        )
+    ]
 
 
 def place_all_orders(kite_client, orders_to_place):
     """
-    Simulates placing all confirmed orders in a batch.
-    This function acts as the 'kite_utils' module wrapper.
+    Places all confirmed orders in a batch, reporting progress inline as each
+    leg completes instead of rerunning the script afterwards.
     """
+    from kiteconnect.exceptions import TokenException
+
     successful_orders = []
     failed_orders = []
+    token_expired = False
+    completed = 0
 
     st.toast("Starting batch order placement...")
 
-    # Simulating order placement logic
-    for order in orders_to_place:
-        symbol = order["symbol"]
-        action = order["Action"]
-        quantity = order["quantity"]
-        buy_price = order["buy_price"]
-        sell_price = order["sell_price"]
+    # Submit every order leg at once (BOTH legs run in parallel too) on one
+    # event loop; UI feedback stays on the script thread
+    legs = [
+        (
+            order.symbol,
+            leg,
+            order.buy_price if leg == "BUY" else order.sell_price,
+            order.quantity,
+        )
+        for order in orders_to_place
+        for leg in ACTION_LEGS.get(order.action, ())
+    ]
+    progress = st.empty()
 
-        try:
-            if action in ["BUY", "BOTH"]:
-                place_buy_order(kite_client, symbol, buy_price, quantity)
-                st.toast(f"BUY: {symbol} @ ₹{buy_price} (Qty: {quantity})")
+    def _on_result(placed_leg, result):
+        nonlocal token_expired, completed
+        symbol, leg, price, quantity = placed_leg
 
-            if action in ["SELL", "BOTH"]:
-                place_sell_order(kite_client, symbol, sell_price, quantity)
-                st.toast(f"SELL: {symbol} @ ₹{sell_price} (Qty: {quantity})")
+        if isinstance(result, TokenException):
+            token_expired = True
 
-            successful_orders.append(f"{symbol} ({action})")
+        elif isinstance(result, Exception):
+            failed_orders.append(f"{symbol} ({leg}): {result}")
+            st.error(f"Failed to place order for {symbol} ({leg}): {result}")
 
-        except Exception as e:
-            failed_orders.append(f"{symbol} ({action}): {e}")
-            st.error(f"Failed to place order for {symbol} ({action}): {e}")
+        else:
+            st.toast(f"{leg}: {symbol} @ ₹{price} (Qty: {quantity})")
+            successful_orders.append(f"{symbol} ({leg})")
+
+        completed += 1
+        progress.progress(
+            completed / len(legs), text=f"Placed {completed}/{len(legs)} orders"
+        )
+
+    place_legs(
+        kite_client, legs, max_concurrency=ORDER_WORKERS, on_result=_on_result
+    )
+    if token_expired:
+        handle_token_expiry()
 
     # Display final results
     if successful_orders:
         st.success(f"✅ Successfully placed {len(successful_orders)} orders.")
     if failed_orders:
         st.error(f"❌ Failed to place {len(failed_orders)} orders.")
+    st.info("Open the Order Book to track these orders.")
 
-    # Clear state after batch placement
+    # Clear state after batch placement; the summary is kept for the Order Book
+    st.session_state.last_batch_result = {
+        "successful": successful_orders,
+        "failed": failed_orders,
+    }
     reset_selection()
-    st.session_state.scanner_data = []
-    st.session_state.sb_navigation = "Order Book"
-    st.rerun()
+    st.session_state.scanner_df = None
+    clear_order_book_cache()
 
 
 # --- Order Book Logic ---
 
 
+@st.cache_data(ttl=2, show_spinner=False)
+def _cached_orders(_kite, access_token):
+    """Today's orders, memoized briefly. `access_token` scopes the cache per account."""
+    return _kite.orders()
+
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _cached_ltp(_kite, instruments):
+    """LTPs for a tuple of instruments, memoized briefly across reruns."""
+    return get_ltps(_kite, instruments)
+
+
+def clear_order_book_cache():
+    """Forces the next order book render to re-fetch from Kite."""
+    _cached_orders.clear()
+    _cached_ltp.clear()
+
+
 def fetch_and_display_orders(kite):
+    import pandas as pd
+    from kiteconnect.exceptions import TokenException
+
     st.title("📒 Daily Order Book")
 
+    # Summary of a batch placed from the Scanner page, shown once
+    batch = st.session_state.pop("last_batch_result", None)
+    if batch:
+        st.success(f"Last batch: {len(batch['successful'])} orders placed.")
+        if batch["failed"]:
+            st.error("Failed: " + "; ".join(batch["failed"]))
+
     with st.spinner("Fetching orders and live prices..."):
         try:
-            orders = kite.orders()
+            orders = _cached_orders(kite, st.session_state.access_token)
             if not orders:
                 st.info("No orders placed today.")
                 return
 
             # 1. Prepare list for LTP fetch
-            unique_instruments = set()
-            for order in orders:
-                exchange = order.get("exchange", "NSE")
-                symbol = order.get("tradingsymbol")
-                unique_instruments.add(f"{exchange}:{symbol}")
-
-            # 2. Fetch LTPs in Batch
+            # Orders without a symbol are dropped rather than sent as "NSE:None"
+            unique_instruments = {
+                f"{o.get('exchange') or 'NSE'}:{sym}"
+                for o in orders
+                if (sym := o.get("tradingsymbol"))
+            }
+
+            # 2. Read LTPs from the tick stream, fetching cold instruments in batch
             ltp_map = {}
-            if unique_instruments:
+            stream = current_tick_stream()
+            if stream:
+                tokens = {
+                    o["instrument_token"]: f"{o.get('exchange') or 'NSE'}:{sym}"
+                    for o in orders
+                    if o.get("instrument_token") and (sym := o.get("tradingsymbol"))
+                }
+                stream.subscribe(tokens)
+                for token, tick in stream.get(tokens).items():
+                    ltp_map[tokens[token]] = tick.get("last_price", 0.0)
+
+            cold = unique_instruments - ltp_map.keys()
+            if cold:
                 try:
-                    ltp_response = kite.ltp(list(unique_instruments))
+                    ltp_response = _cached_ltp(kite, tuple(sorted(cold)))
                     for key, value in ltp_response.items():
                         ltp_map[key] = value.get("last_price", 0.0)
                 except Exception as e:
                     st.error(f"Error fetching LTPs: {e}")
 
-            # 3. Process orders for display
-            display_data = []
-            for order in orders:
-                exchange = order.get("exchange", "NSE")
-                symbol = order.get("tradingsymbol")
-                instrument_key = f"{exchange}:{symbol}"
-
-                status = order.get("status")
-
-                display_data.append(
-                    {
-                        "Time": order.get("order_timestamp"),
-                        "Symbol": symbol,
-                        "Type": order.get("transaction_type"),
-                        "Status": status,
-                        "Qty": f"{order.get('filled_quantity', 0)}/{order.get('quantity', 0)}",
-                        "Order Price": order.get("price", 0),
-                        "LTP": ltp_map.get(instrument_key, 0.0),
-                    }
-                )
+            # 3. Process orders for display (columnar, no per-order dicts)
+            # Only the displayed fields are materialised, not every order key
+            df = pd.DataFrame(
+                orders,
+                columns=[
+                    "order_timestamp",
+                    "exchange",
+                    "tradingsymbol",
+                    "transaction_type",
+                    "status",
+                    "filled_quantity",
+                    "quantity",
+                    "price",
+                ],
+            )
+            # datetime64 up front so the sort below compares ints, not objects
+            df["order_timestamp"] = pd.to_datetime(df["order_timestamp"])
+            instrument_keys = df["exchange"].fillna("NSE") + ":" + df["tradingsymbol"]
+            df["Qty"] = (
+                df["filled_quantity"].fillna(0).astype(int).astype(str)
+                + "/"
+                + df["quantity"].fillna(0).astype(int).astype(str)
+            )
+            df["LTP"] = instrument_keys.map(ltp_map).fillna(0.0)
+            df["price"] = df["price"].fillna(0)
 
             # 4. Display DataFrame
-            df = pd.DataFrame(display_data)
+            df = df.rename(
+                columns={
+                    "order_timestamp": "Time",
+                    "tradingsymbol": "Symbol",
+                    "transaction_type": "Type",
+                    "status": "Status",
+                    "price": "Order Price",
+                }
+            )[["Time", "Symbol", "Type", "Status", "Qty", "Order Price", "LTP"]]
 
             if not df.empty and "Time" in df.columns:
                 df = df.sort_values(by="Time", ascending=False)
@@ -351,6 +649,7 @@ def fetch_and_display_orders(kite):
 
             with col_refresh:
                 if st.button("🔄 Refresh Status"):
+                    clear_order_book_cache()
                     st.rerun()
 
             with col_cancel:
@@ -379,6 +678,7 @@ def fetch_and_display_orders(kite):
                             st.success(
                                 f"Successfully cancelled {success_count} orders."
                             )
+                            clear_order_book_cache()
                             st.rerun()
                 else:
                     st.button(
@@ -388,31 +688,149 @@ def fetch_and_display_orders(kite):
                         help="No open orders to cancel",
                     )
 
+        except TokenException:
+            handle_token_expiry()
         except Exception as e:
             st.error(f"Failed to fetch orders: {e}")
 
 
+# --- Scanner Views ---
+
+
+@st.fragment
+def render_selection_table(kite, multiplier):
+    """
+    Renders the action-selection table and the Proceed button.
+
+    Runs as a fragment so editing the table only reruns this block, not the
+    whole script; `st.rerun()` on Proceed still triggers a full app rerun.
+    Small result sets get a multiselect picker instead of the heavier grid.
+    """
+    st.markdown("### Step 2: Select Action for Stocks")
+    st.info(
+        f"Capital: ₹{st.session_state.capital:,.0f}, Strategy: {st.session_state.capital_strategy}"
+    )
+
+    df = st.session_state.scanner_df
+    compact = len(df) <= COMPACT_SELECTION_MAX and not st.toggle(
+        "Set actions per stock", key="per_stock_actions"
+    )
+
+    if compact:
+        rationales = dict(zip(df["symbol"], df["rationale"]))
+        picked = st.multiselect(
+            "Select stocks",
+            df["symbol"].tolist(),
+            format_func=lambda s: f"{s} — {rationales.get(s, '')}",
+            key="compact_symbols",
+        )
+        compact_action = st.radio(
+            "Action", ["BUY", "SELL", "BOTH"], horizontal=True, key="compact_action"
+        )
+    else:
+        _render_selection_editor(df)
+
+    st.write("")
+    col_proceed, col_quotes = st.columns([3, 1])
+    with col_quotes:
+        if st.button("↻ Refresh quotes", use_container_width=True):
+            if refresh_quote_cache(kite, df["symbol"].tolist(), force=True):
+                st.toast("Quotes refreshed.")
+            else:
+                st.toast("Could not refresh quotes.")
+
+    with col_proceed:
+        proceed_clicked = st.button("Proceed to Review ➡️", type="primary")
+
+    if proceed_clicked:
+        if compact:
+            df["Action"] = "SKIP"
+            df.loc[df["symbol"].isin(picked), "Action"] = compact_action
+        else:
+            # Apply only the edited cells to the stored frame instead of
+            # materialising a whole edited copy
+            edits = st.session_state.selection_editor["edited_rows"]
+            for pos, changes in edits.items():
+                for col, value in changes.items():
+                    df.iat[int(pos), df.columns.get_loc(col)] = value
+
+        _proceed_to_review(kite, df, multiplier)
+
+
+def _render_selection_editor(df):
+    """Renders the per-stock Action grid."""
+    st.data_editor(
+        df,
+        column_config={
+            # ACTION DROPDOWN (Requested feature)
+            "Action": st.column_config.SelectboxColumn(
+                "Action",
+                options=["SKIP", "BUY", "SELL", "BOTH"],
+                default="SKIP",
+                required=True,
+            ),
+            "symbol": "Symbol",
+            "rationale": "Rationale",
+            # SHOW TRUE RANGE (Requested feature)
+            "true_range": st.column_config.NumberColumn("True Range", format="₹%.2f"),
+        },
+        hide_index=True,
+        use_container_width=True,
+        num_rows="fixed",
+        key="selection_editor",
+    )
+
+
+def _proceed_to_review(kite, df, multiplier):
+    """Finalizes the rows with an Action and moves to the review step."""
+    mask = df["Action"].ne("SKIP").to_numpy()
+    clean_data = df.loc[mask].to_dict("records")
+
+    if clean_data:
+        # Top up the prefetched quotes in one batched call
+        if not refresh_quote_cache(kite, [r["symbol"] for r in clean_data]):
+            st.error("Could not fetch quotes from Kite. Please try again.")
+            return
+
+        # Calculate quantities and final prices
+        finalized_data = calculate_quantity_and_finalize(
+            clean_data,
+            multiplier,
+            st.session_state.capital,
+            st.session_state.capital_strategy,
+        )
+
+        if finalized_data:
+            st.session_state.selected_scanner_data = finalized_data
+            st.session_state.finalized_multiplier = multiplier
+            st.session_state.selection_done = True
+            st.rerun()
+        else:
+            st.error("No stocks passed the market data fetch and finalization stage.")
+    else:
+        st.error(
+            "Please select an action other than 'SKIP' for at least one stock to proceed."
+        )
+
+
 # --- Main App ---
 
 
 def main():
-    # Auto-login check
-    if not st.session_state.is_logged_in:
-        # Check if we are in the redirect flow
-        if not st.query_params.get("request_token"):
-            # Try loading saved session from disk
-            if load_session_from_disk():
-                st.rerun()
+    # Read the redirect-flow token once per rerun
+    request_token = st.query_params.get("request_token")
 
     # ---------------------------------------------------------
     # PART 1: LOGGED IN DASHBOARD
     # ---------------------------------------------------------
     if st.session_state.is_logged_in:
+        # Heavy imports are deferred so the login splash paints faster
+        import pandas as pd
+
         user = st.session_state.user_data
 
         # Initialize Kite
-        kite = KiteConnect(api_key=st.session_state.user_api_key)
-        kite.set_access_token(st.session_state.access_token)
+        kite = get_kite(st.session_state.user_api_key, st.session_state.access_token)
 
         with st.sidebar:
             st.success(f"User: {user.get('user_name')}")
@@ -447,12 +865,38 @@ def main():
                 )
 
                 st.write("")
-                if st.button("Fetch & Select Stocks", type="primary"):
+                fetch_clicked = st.button("Fetch & Select Stocks", type="primary")
+                refresh_clicked = st.button(
+                    "🔄 Refresh", help="Bypass the cache and re-query Supabase"
+                )
+                if refresh_clicked:
+                    _fetch_scanner_results_cached.clear()
+
+                if fetch_clicked or refresh_clicked:
                     results = fetch_scanner_results(scan_date)
                     if results:
-                        st.session_state.scanner_data = results
+                        # Keep results columnar; built once instead of on every rerun
+                        df = pd.DataFrame(results)
+                        if "Action" not in df.columns:
+                            df.insert(0, "Action", "SKIP")
+                        st.session_state.scanner_df = df
+
+                        # Warm quotes in the background while the user picks actions
+                        st.session_state.quote_cache = {}
+                        prefetch_quotes(
+                            kite,
+                            [r["symbol"] for r in results],
+                            st.session_state.quote_cache,
+                            st.session_state.quote_lock,
+                        )
                         st.session_state.selection_done = False
                         st.success(f"Fetched {len(results)} records.")
+                        if len(results) == SCANNER_RESULT_LIMIT:
+                            st.warning(
+                                f"Only the first {SCANNER_RESULT_LIMIT} results "
+                                "(by symbol) were fetched; this date may have "
+                                "more."
+                            )
                     else:
                         st.warning("No data found for this date.")
 
@@ -460,8 +904,7 @@ def main():
                 st.info("Check status of today's orders.")
 
             st.divider()
-            if st.button("Logout"):
-                logout()
+            st.button("Logout", on_click=logout)
 
         # --- Page Routing ---
 
@@ -474,69 +917,8 @@ def main():
 
             # VIEW 1: SELECTION TABLE & FINALIZATION
             if not st.session_state.selection_done:
-                if st.session_state.scanner_data:
-                    st.markdown("### Step 2: Select Action for Stocks")
-                    st.info(
-                        f"Capital: ₹{st.session_state.capital:,.0f}, Strategy: {st.session_state.capital_strategy}"
-                    )
-
-                    df = pd.DataFrame(st.session_state.scanner_data)
-
-                    # Ensure Action column exists for the dropdown
-                    if "Action" not in df.columns:
-                        df.insert(0, "Action", "SKIP")
-
-                    edited_df = st.data_editor(
-                        df,
-                        column_config={
-                            # ACTION DROPDOWN (Requested feature)
-                            "Action": st.column_config.SelectboxColumn(
-                                "Action",
-                                options=["SKIP", "BUY", "SELL", "BOTH"],
-                                default="SKIP",
-                                required=True,
-                            ),
-                            "symbol": "Symbol",
-                            "rationale": "Rationale",
-                            # SHOW TRUE RANGE (Requested feature)
-                            "true_range": st.column_config.NumberColumn(
-                                "True Range", format="₹%.2f"
-                            ),
-                        },
-                        hide_index=True,
-                        use_container_width=True,
-                        key="selection_editor",
-                    )
-
-                    st.write("")
-                    if st.button("Proceed to Review ➡️", type="primary"):
-                        st.session_state.scanner_data = edited_df.to_dict("records")
-                        selected_rows = edited_df[edited_df["Action"] != "SKIP"]
-
-                        if not selected_rows.empty:
-                            clean_data = selected_rows.to_dict("records")
-
-                            # Calculate quantities and final prices
-                            finalized_data = calculate_quantity_and_finalize(
-                                kite,
-                                clean_data,
-                                multiplier,
-                                st.session_state.capital,
-                                st.session_state.capital_strategy,
-                            )
-
-                            if finalized_data:
-                                st.session_state.selected_scanner_data = finalized_data
-                                st.session_state.selection_done = True
-                                st.rerun()
-                            else:
-                                st.error(
-                                    "No stocks passed the market data fetch and finalization stage."
-                                )
-                        else:
-                            st.error(
-                                "Please select an action other than 'SKIP' for at least one stock to proceed."
-                            )
+                if st.session_state.scanner_df is not None:
+                    render_selection_table(kite, multiplier)
                 else:
                     st.info(
                         "👈 Use the sidebar to fetch scanner results and configure capital."
@@ -544,7 +926,16 @@ def main():
 
             # VIEW 2: REVIEW DASHBOARD & BATCH PLACEMENT
             else:
+                # Bind session state to a local once; each access goes through a proxy
                 rows = st.session_state.selected_scanner_data
+
+                # Targets are precomputed on Proceed; only redo them if the
+                # multiplier has since been changed in the sidebar
+                if st.session_state.finalized_multiplier != multiplier:
+                    rows = reprice_orders(rows, multiplier)
+                    st.session_state.selected_scanner_data = rows
+                    st.session_state.finalized_multiplier = multiplier
+
                 st.markdown("### Step 3: Final Order Review")
 
                 if st.button("⬅️ Back to Stock Selection"):
@@ -555,24 +946,25 @@ def main():
                     f"Total {len(rows)} orders pending confirmation. Strategy: {st.session_state.capital_strategy}"
                 )
 
-                review_df = pd.DataFrame(rows)
-                # Display required columns for review
-                review_df = review_df[
-                    [
-                        "symbol",
-                        "Action",
-                        "open_price",
-                        "buy_price",
-                        "sell_price",
-                        "quantity",
-                    ]
+                # Display required columns for review; st.dataframe takes the
+                # records directly, so no DataFrame is built per rerun
+                review_rows = [
+                    {
+                        "symbol": r.symbol,
+                        "action": r.action,
+                        "open_price": r.open_price,
+                        "buy_price": r.buy_price,
+                        "sell_price": r.sell_price,
+                        "quantity": r.quantity,
+                    }
+                    for r in rows
                 ]
 
                 st.dataframe(
-                    review_df,
+                    review_rows,
                     column_config={
                         "symbol": "Symbol",
-                        "Action": "Action",
+                        "action": "Action",
                         "open_price": st.column_config.NumberColumn(
                             "Open Price", format="₹%.2f"
                         ),
@@ -599,8 +991,7 @@ def main():
     # ---------------------------------------------------------
     # PART 2: LOGIN FLOW
     # ---------------------------------------------------------
-    elif st.query_params.get("request_token"):
-        request_token = st.query_params.get("request_token")
+    elif request_token:
         stored_key = st.session_state.get("user_api_key")
         stored_secret = st.session_state.get("user_api_secret")
 
@@ -620,6 +1011,10 @@ def main():
                         st.query_params.clear()
                         st.rerun()
 
+    # Auto-login check: try loading saved session from disk
+    elif load_session_from_disk():
+        st.rerun()
+
     else:
         st.title("Scanner Login")
         with st.form("init_form"):
@@ -629,6 +1024,8 @@ def main():
                 if api_key and api_secret:
                     st.session_state.user_api_key = api_key
                     st.session_state.user_api_secret = api_secret
+                    from kiteconnect import KiteConnect
+
                     kite = KiteConnect(api_key=api_key)
                     st.link_button(
                         "Login with Zerodha", kite.login_url(), type="primary"
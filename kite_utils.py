@@ -1,130 +1,242 @@
-from kiteconnect import KiteConnect
-
-
-def get_ohlc_data(kite_client, symbol):
-    """Fetches LTP and Open price for a given symbol from NSE."""
-    try:
-        instrument = f"NSE:{symbol}"
-        quote = kite_client.quote([instrument])
-        data = quote.get(instrument, {})
-
-        ltp = data.get("last_price", 0.0)
-        open_price = data.get("ohlc", {}).get("open", 0.0)
-        return ltp, open_price
-    except Exception as e:
-        # Suppress error for cleaner UI; only return 0.0
-        return 0.0, 0.0
-
-
-def place_buy_order(kite: KiteConnect, symbol, buy_price, qty):
-    try:
-        # 1. BUY order (MIS + Limit)
-        buy_id = kite.place_order(
-            variety=kite.VARIETY_REGULAR,
-            exchange=kite.EXCHANGE_NSE,
-            tradingsymbol=symbol,
-            transaction_type=kite.TRANSACTION_TYPE_BUY,
-            quantity=qty,
-            product=kite.PRODUCT_MIS,
-            order_type=kite.ORDER_TYPE_LIMIT,
-            price=buy_price,
-            validity=kite.VALIDITY_DAY,
-        )
-        print(f"{symbol} | BUY placed  @ {buy_price} | ID: {buy_id}")
-
-    except Exception as e:
-        print(f"Failed for {symbol}: {e}")
-        raise e
-
-
-def place_sell_order(kite: KiteConnect, symbol, sell_price, qty):
-
-    try:
-        # SELL order (MIS + Limit) – placed immediately
-        sell_id = kite.place_order(
-            variety=kite.VARIETY_REGULAR,
-            exchange=kite.EXCHANGE_NSE,
-            tradingsymbol=symbol,
-            transaction_type=kite.TRANSACTION_TYPE_SELL,
-            quantity=qty,
-            product=kite.PRODUCT_MIS,
-            order_type=kite.ORDER_TYPE_LIMIT,
-            price=sell_price,
-            validity=kite.VALIDITY_DAY,
-        )
-        print(f"{symbol} | SELL placed @ {sell_price} | ID: {sell_id}")
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import TYPE_CHECKING
+
+import httpx
+
+if TYPE_CHECKING:
+    # Only needed for annotations; keeps kiteconnect off the import path
+    from kiteconnect import KiteConnect
+
+logger = logging.getLogger(__name__)
+
+# A finalized order ready for review/placement. Defined here rather than in
+# app.py so the class survives Streamlit script reruns.
+OrderRow = namedtuple(
+    "OrderRow",
+    "symbol rationale true_range action open_price buy_price sell_price quantity",
+)
+
+# Order legs placed for each scanner Action
+ACTION_LEGS = {
+    "BUY": ("BUY",),
+    "SELL": ("SELL",),
+    "BOTH": ("BUY", "SELL"),
+    "SKIP": (),
+}
+
+# Kite's quote/ltp endpoints accept at most this many instruments per call
+MAX_INSTRUMENTS_PER_CALL = 500
+
+# Kite's order placement endpoint accepts at most this many requests per second
+ORDERS_PER_SECOND = 10
+
+
+def _chunked(seq, size=MAX_INSTRUMENTS_PER_CALL):
+    """Yields successive lists of at most `size` items from `seq`."""
+    it = iter(seq)
+    while chunk := list(islice(it, size)):
+        yield chunk
 
-    except Exception as e:
-        print(f"Failed for {symbol}: {e}")
-        raise e
 
+def get_quotes(kite_client, symbols):
+    """Fetches quotes for all given NSE symbols in as few batched calls as possible."""
+    quotes = {}
+    for chunk in _chunked(f"NSE:{symbol}" for symbol in symbols):
+        quotes.update(kite_client.quote(chunk))
+    return quotes
 
-def calculate_quantity_and_finalize(
-    kite_client, selected_data, multiplier, capital, strategy
-):
+
+def get_ltps(kite_client, instruments, max_workers=4):
+    """Fetches LTPs for instruments, splitting them into concurrent per-call batches."""
+    ltps = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        for part in ex.map(kite_client.ltp, _chunked(instruments)):
+            ltps.update(part)
+    return ltps
+
+
+def prefetch_quotes(kite_client, symbols, quote_cache, lock):
+    """Fetches quotes in a background thread and merges them into `quote_cache`."""
+
+    def _worker():
+        try:
+            quotes = get_quotes(kite_client, symbols)
+        except Exception as e:
+            logger.warning(f"Quote prefetch failed: {e}")
+            return
+        with lock:
+            quote_cache.update(quotes)
+
+    thread = threading.Thread(target=_worker, daemon=True)
+    thread.start()
+    return thread
+
+
+class TickStream:
+    """
+    Keeps one KiteTicker websocket open and the latest tick per instrument
+    token, so hot reads skip the REST quote/ltp round trip. Ticks arrive on
+    the ticker's own thread; readers go through `get`.
     """
-    Calculates final prices, quantities, and prepares the data for review.
 
-    UPDATED: Buy/Sell prices rounded to 1 decimal place (multiple of 0.1).
-    UPDATED: Equal distribution quantity based on Open Price.
+    def __init__(self, api_key, access_token):
+        from kiteconnect import KiteTicker
+
+        self._ticks = {}
+        self._lock = threading.Lock()
+        self._subscribed = set()
+        self._connected_once = False
+        self._ticker = KiteTicker(api_key, access_token)
+        self._ticker.on_ticks = self._on_ticks
+        self._ticker.on_connect = self._on_connect
+        self._ticker.on_error = self._on_error
+        self._ticker.on_close = self._on_close
+        self._ticker.connect(threaded=True)
+
+    def _on_ticks(self, ws, ticks):
+        with self._lock:
+            for tick in ticks:
+                self._ticks[tick["instrument_token"]] = tick
+
+    def _on_connect(self, ws, response):
+        # Sends tokens requested before the socket first opened; KiteTicker
+        # resubscribes on its own after a reconnect
+        with self._lock:
+            if self._connected_once:
+                return
+            self._connected_once = True
+            tokens = list(self._subscribed)
+        if tokens:
+            ws.subscribe(tokens)
+            ws.set_mode(ws.MODE_QUOTE, tokens)
+
+    def _on_error(self, ws, code, reason):
+        logger.warning(f"Tick stream error {code}: {reason}")
+
+    def _on_close(self, ws, code, reason):
+        # Ticks stop updating once the socket is down; drop them so readers
+        # fall back to REST instead of serving frozen prices
+        with self._lock:
+            self._ticks.clear()
+
+    def subscribe(self, tokens):
+        """Starts streaming any of `tokens` not already subscribed."""
+        with self._lock:
+            new = set(tokens) - self._subscribed
+            self._subscribed |= new
+        if new and self._ticker.is_connected():
+            self._ticker.subscribe(list(new))
+            self._ticker.set_mode(self._ticker.MODE_QUOTE, list(new))
+
+    def close(self):
+        """Closes the websocket and stops KiteTicker's reconnect loop."""
+        self._ticker.close()
+
+    def get(self, tokens):
+        """
+        Returns the latest tick for each of `tokens` that has received one, or
+        nothing while the socket is disconnected.
+        """
+        if not self._ticker.is_connected():
+            return {}
+        with self._lock:
+            return {t: self._ticks[t] for t in tokens if t in self._ticks}
+
+
+def _raise_for_kite_error(response):
+    """Raises the kiteconnect exception matching an error response from Kite."""
+    from kiteconnect import exceptions as ex
+
+    # Gateway errors (e.g. a 502/504 HTML page) aren't Kite responses
+    content_type = response.headers.get("content-type", "")
+    if "json" not in content_type:
+        raise ex.DataException(
+            f"Unknown Content-Type ({content_type}) "
+            f"with response: ({response.content!r})"
+        )
+    data = response.json()
+    if data.get("status") == "error":
+        exc = getattr(ex, data.get("error_type", ""), ex.GeneralException)
+        raise exc(data.get("message", "Unknown error"), code=response.status_code)
+    return data["data"]
+
+
+class _RateLimiter:
+    """Spaces `acquire` calls so at most `rate` pass per second."""
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+async def _place_leg_async(client, semaphore, limiter, symbol, leg, price, qty):
+    """Places a single MIS limit BUY or SELL leg through Kite's REST API."""
+    async with semaphore:
+        await limiter.acquire()
+        response = await client.post(
+            "/orders/regular",
+            data={
+                "exchange": "NSE",
+                "tradingsymbol": symbol,
+                "transaction_type": leg,
+                "quantity": qty,
+                "product": "MIS",
+                "order_type": "LIMIT",
+                "price": price,
+                "validity": "DAY",
+            },
+        )
+    order_id = _raise_for_kite_error(response)["order_id"]
+    logger.info(f"{symbol} | {leg} placed @ {price} | ID: {order_id}")
+    return order_id
+
+
+async def _place_legs_async(kite: KiteConnect, legs, max_concurrency, on_result):
+    headers = {
+        "X-Kite-Version": "3",
+        "Authorization": f"token {kite.api_key}:{kite.access_token}",
+    }
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limiter = _RateLimiter(ORDERS_PER_SECOND)
+
+    async def _place(leg):
+        try:
+            result = await _place_leg_async(client, semaphore, limiter, *leg)
+        except Exception as e:
+            result = e
+        if on_result:
+            on_result(leg, result)
+        return result
+
+    async with httpx.AsyncClient(
+        base_url=kite.root, headers=headers, http2=True, timeout=10.0
+    ) as client:
+        return await asyncio.gather(*(_place(leg) for leg in legs))
+
+
+def place_legs(kite: KiteConnect, legs, max_concurrency=8, on_result=None):
+    """
+    Places `(symbol, leg, price, qty)` order legs concurrently over one HTTP/2
+    connection, submitting at most `ORDERS_PER_SECOND` of them per second and
+    in list order, so a BOTH row's BUY goes out before its SELL. Returns, per
+    leg and in order, the order ID or the exception raised placing it.
+    `on_result(leg, result)` is called on the calling thread as each leg
+    completes.
     """
-    finalized_data = []
-
-    # 1. Fetch OHLC data for all selected stocks
-    symbols = [row["symbol"] for row in selected_data]
-    ohlc_map = {}
-    for symbol in symbols:
-        _, open_price = get_ohlc_data(kite_client, symbol)
-        ohlc_map[symbol] = open_price
-
-    # 2. Calculate final order details (Buy Price, Sell Price, Delta)
-    for row in selected_data:
-        symbol = row["symbol"]
-        open_price = ohlc_map.get(symbol, 0.0)
-
-        if open_price == 0.0:
-            st.warning(
-                f"Skipping {symbol}: Could not fetch Open Price. Ensure the market is open or data is available."
-            )
-            continue
-
-        metric_base_val = float(row.get("true_range", 0))
-        delta = metric_base_val * multiplier
-
-        # Calculate raw Buy and Sell prices
-        calc_buy = open_price - delta
-        calc_sell = open_price + delta
-
-        # Apply rounding to 1 decimal place (multiple of 0.1) as requested
-        row["open_price"] = float(f"{open_price:.2f}")
-        row["buy_price"] = round(calc_buy, 1)  # Rounded to 0.1 precision
-        row["sell_price"] = round(calc_sell, 1)  # Rounded to 0.1 precision
-        finalized_data.append(row)
-
-    if not finalized_data:
-        st.error("No stocks could be processed after fetching market data.")
-        return []
-
-    # 3. Calculate Quantity based on Strategy
-    num_stocks = len(finalized_data)
-
-    for row in finalized_data:
-        if strategy == "One each":
-            row["quantity"] = 1
-
-        elif strategy == "Equal distribution":
-            if num_stocks > 0:
-                # Calculate budget per stock
-                budget_per_stock = capital / num_stocks
-
-                # Use Open Price as the basis for quantity calculation (Requested change)
-                price_proxy = row["open_price"]
-
-                if price_proxy > 0:
-                    quantity = math.floor(budget_per_stock / price_proxy)
-                    # Ensure minimum quantity of 1 if budget allows
-                    row["quantity"] = max(1, quantity)
-                else:
-                    row["quantity"] = 1  # Fallback
-
-    return finalized_data
+    return asyncio.run(_place_legs_async(kite, legs, max_concurrency, on_result))
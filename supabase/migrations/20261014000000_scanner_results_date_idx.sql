@@ -0,0 +1,3 @@
+-- Backs the dashboard's per-date scanner query (filter on date, ordered by symbol)
+create index if not exists scanner_results_date_symbol_idx
+    on public.scanner_results (date, symbol);